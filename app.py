@@ -1,7 +1,11 @@
 # app.py （削除後 rerun 安定版）
 import os
 import json
+import logging
 import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
 from datetime import datetime
 from zoneinfo import ZoneInfo
 import pandas as pd
@@ -9,6 +13,7 @@ import streamlit as st
 
 APP_TITLE = "安否確認（QR自動登録・管理）"
 TZ = ZoneInfo("Asia/Tokyo")
+logger = logging.getLogger(__name__)
 
 # DB 永続保存パス
 DB_DIR = os.path.join(os.getcwd(), ".streamlit")
@@ -17,8 +22,80 @@ DB_PATH = os.path.join(DB_DIR, "safetycheck.db")
 BACKUP_DIR = os.path.join(DB_DIR, "backups")
 os.makedirs(BACKUP_DIR, exist_ok=True)
 
+# 利用者画面に出す列（raw_params / user_agent は読まない）
+HISTORY_COLUMNS = ("id", "ts", "nick", "addr", "school", "tel", "status")
+# IN (...) のプレースホルダ数の上限（SQLITE_MAX_VARIABLE_NUMBER の既定 999 未満に抑える）
+ID_CHUNK = 500
+# これ以下の LIMIT は read_sql_query を通さずカーソルから直接 DataFrame を作る
+SMALL_LIMIT = 200
+# 削除後の再描画でバックアップの書き出し完了を待つ最大秒数
+BACKUP_WAIT_SECONDS = 10
+# 標準フィールド名 → 受け付けるクエリキー
+PARAM_ALIASES = (
+    ("nick", ("nick",)),
+    ("addr", ("addr",)),
+    ("school", ("school",)),
+    ("tel", ("tel",)),
+)
+
+# 同じ QR（nick/addr/school/tel）・同じ状態の同一分内の登録は重複として挿入しない
+SQL_INSERT_CHECKIN = """
+    INSERT INTO checkins (ts, nick, addr, school, tel, status, raw_params, sms_sent, user_agent)
+    SELECT :ts, :nick, :addr, :school, :tel, :status, :raw_params, 0, :user_agent
+    WHERE NOT EXISTS (
+        SELECT 1 FROM checkins
+        WHERE nick = :nick AND status = :status AND substr(ts, 1, 16) = substr(:ts, 1, 16)
+          AND addr = :addr AND school = :school AND tel = :tel
+    )
+"""
+# deletions に退避する checkins の列（deletions 側の列名, 型, checkins 側の列名）
+DELETIONS_ROW_COLUMNS = (
+    ("checkin_id", "INTEGER", "id"),
+    ("ts", "TEXT", "ts"),
+    ("nick", "TEXT", "nick"),
+    ("addr", "TEXT", "addr"),
+    ("school", "TEXT", "school"),
+    ("tel", "TEXT", "tel"),
+    ("status", "TEXT", "status"),
+    ("raw_params", "TEXT", "raw_params"),
+    ("sms_sent", "INTEGER", "sms_sent"),
+    ("user_agent", "TEXT", "user_agent"),
+)
+SQL_ARCHIVE_BY_IDS = (
+    "INSERT INTO deletions (deleted_at, deleted_by, reason, "
+    + ", ".join(c[0] for c in DELETIONS_ROW_COLUMNS)
+    + ") SELECT ?, ?, ?, "
+    + ", ".join(c[2] for c in DELETIONS_ROW_COLUMNS)
+    + " FROM checkins WHERE id IN ({ph})"
+)
+SQL_HISTORY_BASE = "SELECT {cols} FROM checkins WHERE 1=1"
+SQL_DELETE_BY_IDS = "DELETE FROM checkins WHERE id IN ({ph}) RETURNING *"
+
+@st.cache_resource
+def get_db(db_path=DB_PATH):
+    # rerun ごとに connect し直さず、プロセス内で 1 本の接続を共有する。
+    # 接続とそのロックは同じキャッシュ項目で返し、キャッシュ削除で組がずれないようにする
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    # NORMAL + WAL: commit ごとの完全な fsync が WAL への追記 1 回になる。
+    # プロセス内の読み書きは上の共有接続とロックで直列化されるため、WAL で並行になるのは別プロセスの読み取りだけ
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")
+    return conn, threading.Lock()
+
+@contextmanager
+def db_conn():
+    # 共有接続はセッション（スレッド）間で排他して使う。正常終了で commit、例外で rollback
+    conn, lock = get_db(DB_PATH)
+    with lock:
+        with conn:
+            yield conn
+
+# スキーマ作成・移行はプロセスごとに 1 回だけ行う
+@st.cache_resource
 def init_db():
-    with sqlite3.connect(DB_PATH) as conn:
+    with db_conn() as conn:
         conn.execute(
             """
             CREATE TABLE IF NOT EXISTS checkins (
@@ -39,92 +116,143 @@ def init_db():
                 deleted_at TEXT NOT NULL,
                 deleted_by TEXT,
                 reason TEXT,
-                deleted_row_json TEXT
+                deleted_row_json TEXT,           -- 旧形式（JSON）の削除行
+                checkin_id INTEGER,
+                ts TEXT,
+                nick TEXT, addr TEXT, school TEXT, tel TEXT,
+                status TEXT,
+                raw_params TEXT,
+                sms_sent INTEGER,
+                user_agent TEXT
             )
             """
         )
-        conn.commit()
+        # 旧形式（JSON 列のみ）の deletions に退避用の列を追加する
+        existing = {r[1] for r in conn.execute("PRAGMA table_info(deletions)")}
+        for name, decl, _ in DELETIONS_ROW_COLUMNS:
+            if name not in existing:
+                conn.execute(f"ALTER TABLE deletions ADD COLUMN {name} {decl}")
+        # 利用者画面の nick 完全一致検索用（旧 idx_checkins_nick は NOCASE 版が残りうるので作り直さず削除する）
+        conn.execute("DROP INDEX IF EXISTS idx_checkins_nick")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_checkins_nick_exact ON checkins(nick)")
+        # insert_record の重複チェック用（nick 先頭で絞り、addr/school/tel は行ごとに比較する）
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_checkins_dedup ON checkins(nick, status, substr(ts, 1, 16))"
+        )
 
 def now_jst_iso():
     return datetime.now(TZ).isoformat(timespec="seconds")
 
-def get_query_params():
-    try:
+# 使える query params API は起動時に一度だけ判定する
+if hasattr(st, "query_params"):
+    def get_query_params():
         return st.query_params.to_dict()
-    except Exception:
+else:
+    def get_query_params():
         params = st.experimental_get_query_params()
         return {k: v[0] for k, v in params.items()}
 
 def normalize_params(params: dict):
-    keys = {"nick": "", "addr": "", "school": "", "tel": ""}
-    mapping = {"nick": ["nick"], "addr": ["addr"], "school": ["school"], "tel": ["tel"]}
-    for std, aliases in mapping.items():
+    keys = {}
+    for std, aliases in PARAM_ALIASES:
+        keys[std] = ""
         for k in aliases:
             if k in params:
                 keys[std] = params[k]
     return keys
 
 def insert_record(payload):
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.execute(
-            """
-            INSERT INTO checkins (ts, nick, addr, school, tel, status, raw_params, sms_sent, user_agent)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """,
-            (
-                payload["ts"], payload["nick"], payload["addr"], payload["school"],
-                payload["tel"], payload["status"], json.dumps(payload["raw_params"], ensure_ascii=False),
-                0, payload["user_agent"],
-            ),
-        )
-        conn.commit()
+    # rerun や別タブで同じ QR が開かれても二重登録しない。新規に登録したら 1、重複なら 0 を返す
+    with db_conn() as conn:
+        cnt = conn.execute(
+            SQL_INSERT_CHECKIN,
+            {
+                **payload,
+                "raw_params": json.dumps(payload["raw_params"], ensure_ascii=False),
+            },
+        ).rowcount
+    if cnt:
+        load_history.clear()
+    return cnt
 
-def load_history(limit=None, nick_filter=None):
-    sql = "SELECT * FROM checkins WHERE 1=1"
+# ウィジェット操作ごとの rerun で同じ SELECT を繰り返さない。書き込み側で clear() する
+@st.cache_data(ttl=5, show_spinner=False)
+def load_history(limit=None, nick=None, columns=None):
+    select_cols = ", ".join(columns) if columns else "*"
+    sql = SQL_HISTORY_BASE.format(cols=select_cols)
     params = []
-    if nick_filter:
-        sql += " AND nick LIKE ?"
-        params.append(f"%{nick_filter}%")
+    if nick:
+        sql += " AND nick = ?"
+        params.append(nick)
     sql += " ORDER BY id DESC"
     if limit:
-        sql += f" LIMIT {limit}"
-    return pd.read_sql_query(sql, sqlite3.connect(DB_PATH), params=params)
+        sql += " LIMIT ?"
+        params.append(int(limit))
+    with db_conn() as conn:
+        if limit and limit <= SMALL_LIMIT:
+            cur = conn.execute(sql, params)
+            names = [d[0] for d in cur.description]
+            return pd.DataFrame.from_records(cur.fetchall(), columns=names)
+        return pd.read_sql_query(sql, conn, params=params)
+
+@st.cache_resource
+def get_backup_executor():
+    # バックアップの書き出しは 1 本のワーカーで順に処理し、画面の応答を止めない
+    return ThreadPoolExecutor(max_workers=1)
+
+def _write_backup(df, path):
+    df.to_parquet(path, index=False, compression="zstd")
+    return path
+
+def _log_backup_failure(future):
+    if future.exception() is not None:
+        logger.error("backup failed", exc_info=future.exception())
 
 def backup_rows(df, tag=""):
+    # 書き出しの完了・失敗は返した Future で確認する（show_backup_status）
     ts = datetime.now(TZ).strftime("%Y%m%d_%H%M%S")
-    fname = f"backup_{tag}_{ts}.csv"
+    fname = f"backup_{tag}_{ts}.parquet"
     path = os.path.join(BACKUP_DIR, fname)
-    df.to_csv(path, index=False, encoding="utf-8-sig")
-    return path
+    future = get_backup_executor().submit(_write_backup, df, path)
+    future.add_done_callback(_log_backup_failure)
+    return future
 
-def log_deletions(rows, user="admin", reason=""):
-    with sqlite3.connect(DB_PATH) as conn:
-        for row in rows:
-            conn.execute(
-                """
-                INSERT INTO deletions (deleted_at, deleted_by, reason, deleted_row_json)
-                VALUES (?, ?, ?, ?)
-                """,
-                (
-                    now_jst_iso(),
-                    user,
-                    reason,
-                    json.dumps(row, ensure_ascii=False),
-                ),
-            )
-        conn.commit()
+def show_backup_status():
+    # 未確認のバックアップを少し待ってから結果を出す。終わらなかった分は次の描画に持ち越す
+    futures = st.session_state.get("_backup_futures", [])
+    if not futures:
+        return
+    if not all(f.done() for f in futures):
+        with st.spinner("バックアップを書き出し中です"):
+            wait(futures, timeout=BACKUP_WAIT_SECONDS)
+    pending = []
+    for future in futures:
+        if not future.done():
+            pending.append(future)
+        elif future.exception() is not None:
+            st.error(f"バックアップに失敗しました: {future.exception()}")
+        else:
+            st.success(f"バックアップ: {future.result()}")
+    if pending:
+        st.info(f"バックアップを書き出し中です（{len(pending)} 件）。画面を更新すると結果を表示します")
+    st.session_state["_backup_futures"] = pending
 
-def delete_rows(ids):
+def delete_rows(ids, user="admin", reason=""):
+    # deletions への退避と削除を 1 トランザクションで行い、削除した行そのものを返す
     if not ids:
-        return 0
-    placeholders = ",".join("?" * len(ids))
-    sql = f"DELETE FROM checkins WHERE id IN ({placeholders})"
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.cursor()
-        cur.execute(sql, ids)
-        cnt = cur.rowcount
-        conn.commit()
-    return cnt
+        return []
+    deleted_at = now_jst_iso()
+    rows = []
+    with db_conn() as conn:
+        for i in range(0, len(ids), ID_CHUNK):
+            batch = ids[i:i + ID_CHUNK]
+            ph = ",".join("?" * len(batch))
+            conn.execute(SQL_ARCHIVE_BY_IDS.format(ph=ph), [deleted_at, user, reason, *batch])
+            cur = conn.execute(SQL_DELETE_BY_IDS.format(ph=ph), batch)
+            cols = [d[0] for d in cur.description]
+            rows.extend(dict(zip(cols, r)) for r in cur.fetchall())
+    load_history.clear()
+    return rows
 
 def auto_register(params, raw_params):
     payload = {
@@ -137,8 +265,10 @@ def auto_register(params, raw_params):
         "raw_params": raw_params,
         "user_agent": st.session_state.get("_ua", ""),
     }
-    insert_record(payload)
-    st.success("安否情報を登録しました（無事）")
+    if insert_record(payload):
+        st.success("安否情報を登録しました（無事）")
+    else:
+        st.info("安否情報は登録済みです（無事）")
 
 
 def main():
@@ -155,7 +285,7 @@ def main():
         st.write(f"ニックネーム：{params['nick']}")
         if params["nick"]:
             auto_register(params, raw_params)
-        st.dataframe(load_history(20, params["nick"]))
+        st.dataframe(load_history(20, params["nick"], columns=HISTORY_COLUMNS))
 
     else:
         st.title("管理者モード")
@@ -170,14 +300,15 @@ def main():
         st.dataframe(df, use_container_width=True)
 
         st.subheader("削除操作")
+        show_backup_status()
         selected_ids = st.multiselect("削除対象ID", df["id"].astype(int).tolist())
         reason = st.text_input("削除理由")
         if st.button("選択削除"):
-            rows = df[df["id"].isin(selected_ids)].to_dict("records")
-            path = backup_rows(pd.DataFrame(rows), "manual_delete")
-            log_deletions(rows, reason=reason)
-            delete_rows(selected_ids)
-            st.success(f"{len(rows)} 件削除しました。バックアップ: {path}")
+            rows = delete_rows(selected_ids, reason=reason)
+            st.session_state.setdefault("_backup_futures", []).append(
+                backup_rows(pd.DataFrame(rows), "manual_delete")
+            )
+            st.success(f"{len(rows)} 件削除しました。バックアップを書き出し中です")
             st.session_state["_need_rerun"] = True
 
         if st.session_state.get("_need_rerun"):